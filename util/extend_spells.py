@@ -2,21 +2,28 @@
 
 import argparse
 import re
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
 import logging
-import copy
-from pprint import pprint
 
 description = """Generates Metamagic Spells from original"""
 
+""" Patterns used for inspecting and altering spell data """
+_RE_ANY = re.compile(r'.+')
+_RE_NUMBER = re.compile(r'[0-9]+')
+_RE_ACTIONPOINT = re.compile(r'ActionPoint(?:Group)?')
+
 class Library(object):
     """
         Library of spells
 
         Contains spells in a dictionary indexed by the name of the spell.
     """
+    __slots__ = ('_indexed_spells', '_grouped_spells')
+
     def __init__(self):
         self._indexed_spells = {}
-        self._grouped_spells = {}
+        self._grouped_spells = defaultdict(list)
     
     def __repr__(self):
         spells = ', '.join([str(s) for s in self._indexed_spells.values()])
@@ -27,14 +34,24 @@ class Library(object):
         return self._indexed_spells
 
     def add(self, spell):
+        """ Spells are grouped as they are added, a replaced spell takes over its place in the group """
+        previous = self._indexed_spells.get(spell.name)
         self._indexed_spells[spell.name] = spell
+        if previous is None:
+            self._grouped_spells[spell.get_spellgroup()].append(spell)
+            return
+        group = self._grouped_spells.get(spell.get_spellgroup())
+        if group and previous in group:
+            group[group.index(previous)] = spell
+        else:
+            """ The replaced spell was in another group, regroup to keep the order of the index """
+            self.find_spellgroups()
 
     def find_spellgroups(self):
-        for spellname, spell in self._indexed_spells.items():
-            spellgroup = spell.get_spellgroup()
-            if spellgroup not in self._grouped_spells:
-                self._grouped_spells[spellgroup] = []
-            self._grouped_spells[spellgroup].append(spell)
+        """ Rebuilds spell groups from scratch, e.g. after a spell name or using was changed """
+        self._grouped_spells = defaultdict(list)
+        for spell in self._indexed_spells.values():
+            self._grouped_spells[spell.get_spellgroup()].append(spell)
 
     def print_spellgroups(self):
         for spellgroup, spells in self._grouped_spells.items():
@@ -42,56 +59,56 @@ class Library(object):
             print(f'{spellgroup}: {spelllist}')
 
     """ Extend library with metamagic spells """
-    def create_metamagic(self):
+    def create_metamagic(self, jobs=1):
         metamagic_library = Library()
 
-        for spellgroup, spells in self._grouped_spells.items():
-            logging.debug(f"Creating meta spells for {spellgroup} with spells {spells}")
-            container = Container(spellgroup, spells[0])
-            container.name = f'{spellgroup}_Metamagic'
-            meta_spells = []
-            for spell in spells:
-                spell_containerized = spell.containerized(container)
-                spell_quickened = spell.quickened(container)
-                spell_subtle = spell.subtle(container)
-
-                """ Add containerized spell to meta spells """
-                meta_spells.append(spell_containerized)
-
-                """ Spells with PowerLevel have their data in their using """
-                if spell.has_powerlevel():
-                    test_spell = self._indexed_spells[spell.get_rootspellname()]
-                else:
-                    test_spell = spell
-
-                """ Only add quickened variant for Spells that consume SpellSlots and don't already use BonusAction """
-                if not test_spell.is_container() and test_spell.uses_spellslot() and not test_spell.uses_bonusaction():
-                        meta_spells.append(spell_quickened)
-
-                """ Only add subtle variant for Spells that consume SpellSlots and require verbal component """
-                if not test_spell.is_container() and test_spell.uses_spellslot() and test_spell.has_verbalcomponent():
-                    meta_spells.append(spell_subtle)
-
+        if jobs > 1:
+            """ Spell groups are independent, so build them in worker processes with only the root spells they need """
+            root_spells = [self._find_rootspells(spells) for spells in self._grouped_spells.values()]
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                groups = list(executor.map(_build_group, self._grouped_spells.keys(),
+                                           self._grouped_spells.values(), root_spells, chunksize=64))
+        else:
+            groups = [_build_group(spellgroup, spells, self._indexed_spells)
+                      for spellgroup, spells in self._grouped_spells.items()]
+
+        for container, meta_spells in groups:
             """ Add spells and container to Library only if Container holds more than just the containerized original Spell """
             if meta_spells:
-                for s in meta_spells:
-                    container.add(s)
-
                 metamagic_library.add(container)
                 for s in meta_spells:
                     metamagic_library.add(s)
 
         return metamagic_library
 
-    def load_spells(self):
+    def _find_rootspells(self, spells):
+        """ Root spells of the PowerLevel spells in spells; missing ones are left for _build_group to report """
+        root_spells = {}
+        for spell in spells:
+            if spell.has_powerlevel():
+                rootspellname = spell.get_rootspellname()
+                if rootspellname in self._indexed_spells:
+                    root_spells[rootspellname] = self._indexed_spells[rootspellname]
+        return root_spells
+
+    def iter_blocks(self, src):
+        """ Yields blocks of lines that are separated by empty lines in the file """
+        block = []
+        for line in src:
+            line = line.rstrip('\n')
+            if line:
+                block.append(line)
+            elif block:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    def load_spells(self, blocks):
         """ Processes spell block definitions into Spells """
         
-        """ Break up data into blocks that are separated by empty lines in the file """
-        for block in self._data.split('\n\n'):
-            """ Break up the block into lines for further processing """
-            lines = block.split('\n')
-            
-            """ Skip empty lines """
+        for lines in blocks:
+            """ Skip incomplete blocks """
             if len(lines) < 3:
                 logging.warning("short block found")
                 continue
@@ -103,19 +120,16 @@ class Library(object):
             self.add(spell)
 
     def load(self, filename):
-        """ Loads spells into Library from file """
+        """ Loads spells into Library from file, streaming it block by block """
         with open(filename, 'r') as src:
-            self._data = src.read()
-        self.load_spells()
-        self.find_spellgroups()
-        del self._data
+            self.load_spells(self.iter_blocks(src))
 
     def print(self):
         """ Human readable representation of the Library and Spells """
-        for spellname, spell in self._indexed_spells.items():
-            print(f'{spell.name}')
-            if spell._using:
-                print(f'  Using: {spell._using}')
+        for spell in self._indexed_spells.values():
+            print(spell.name)
+            if spell.using:
+                print(f'  Using: {spell.using}')
             for k, v in spell.data.items():
                 print(f'  {k}: {v}')
             print()
@@ -127,91 +141,75 @@ class Library(object):
     def save(self, filename):
         """ Saves library properly formatted to file """
         with open(filename, 'w') as dst:
-            dst.write(self.to_entries())
+            dst.writelines(self.iter_entries())
+
+    def iter_entries(self):
+        """ Yields library in file format entry by entry, including separators """
+        first = True
+        for spell in self._indexed_spells.values():
+            if not first:
+                yield '\n\n'
+            yield spell.to_entry()
+            first = False
 
     def to_entries(self):
         """ Recreates library in file format """
-        entries = []
-        for spellname, spell in self._indexed_spells.items():
-            entries.append(spell.to_entry())
-        return('\n\n'.join(entries))
+        return ''.join(self.iter_entries())
 
 
 
 class Spell(object):
     """ Spell Object """    
-    def __init__(self):
-        self._name = ""
-        self._entrytype = 'SpellData'
-        self._using = ""
-        self._data = {}
-
-    @property
-    def name(self):
-        return self._name
+    __slots__ = ('name', '_entrytype', '_type', 'using', 'data')
 
-    @name.setter
-    def name(self, value):
-        self._name = value
+    """ Attribute types, kept simple so the module can be compiled with mypyc """
+    name: str
+    _entrytype: str
+    _type: dict[str, str]
+    using: str
+    data: dict[str, str]
 
-    @name.deleter
-    def name(self):
-        del self._name
-
-    @property
-    def using(self):
-        return self._using
-
-    @using.setter
-    def using(self, value):
-        self._using = value
-
-    @using.deleter
-    def using(self):
-        del self._using
-
-    @property
-    def data(self):
-        return self._data
-
-    @data.setter
-    def data(self, value):
-        self._data = value
-
-    @data.deleter
-    def data(self):
-        del self._data
+    def __init__(self):
+        self.name = ""
+        self._entrytype = 'SpellData'
+        self._type = {}
+        self.using = ""
+        self.data = {}
 
     def __repr__(self):
-        return f'Spell({self._name})'
+        return f'Spell({self.name})'
 
     def clone(self):
-        new = Spell()
-        new._name = copy.deepcopy(self._name)
-        new._entrytype = copy.deepcopy(self._entrytype)
-        new._type = copy.deepcopy(self._type)
-        new._using = copy.deepcopy(self._using)
-        new._data = copy.deepcopy(self._data)
+        """ Every slot is assigned below, so skip __init__ and the dicts it would allocate """
+        new = Spell.__new__(Spell)
+        new.name = self.name
+        new._entrytype = self._entrytype
+        """ The spell type header is never altered after loading and can be shared """
+        new._type = self._type
+        new.using = self.using
+        new.data = self.data.copy()
         return new
     
     def alter(self, spelldata):
-        self._data.update(spelldata)
+        self.data.update(spelldata)
 
-    def quickened(self, container):
-        spell_quickened = self.clone().containerized(container)
-        spell_quickened.name = f'{self._name}_Quickened'
+    def quickened(self, base):
+        """ Derives the quickened variant from the already containerized base spell """
+        spell_quickened = base.clone()
+        spell_quickened.name = f'{self.name}_Quickened'
         spell_quickened.add_spelldata('DisplayName', 'Cast Quickened')
-        if not spell_quickened.find_spelldata('UseCosts', '.+'):
+        if not spell_quickened.find_spelldata('UseCosts', _RE_ANY):
             spell_quickened.add_spelldata('UseCosts', self.get_spelldata('UseCost'))
-        spell_quickened.replace_spelldata('UseCosts', 'ActionPoint(Group)?', 'BonusAction')
+        spell_quickened.replace_spelldata('UseCosts', _RE_ACTIONPOINT, 'BonusActionPoint')
         return spell_quickened
 
-    def subtle(self, container):
-        spell_subtle = self.clone().containerized(container)
+    def subtle(self, base):
+        """ Derives the subtle variant from the already containerized base spell """
+        spell_subtle = base.clone()
         spell_subtle.name = f'{self.name}_Subtle'
         spell_subtle.add_spelldata('DisplayName', 'Cast Subtle')
-        spell_subtle.replace_spelldata('SpellFlags', 'HasVerbalComponent[;]*', '')
-        if not spell_subtle.find_spelldata('UseCosts', '.+'):
+        spell_subtle.remove_spellflag('HasVerbalComponent')
+        if not spell_subtle.find_spelldata('UseCosts', _RE_ANY):
             spell_subtle.add_spelldata('UseCosts', self.get_spelldata('UseCost'))
         return spell_subtle
 
@@ -219,46 +217,62 @@ class Spell(object):
         spell_containerized = self.clone()
         spell_containerized.name = f'{self.name}_Original'
         spell_containerized.add_spelldata('DisplayName', 'Cast Unmodified')
-        spell_containerized.add_spelldata('SpellContainerID', f'{container.name}')
+        spell_containerized.add_spelldata('SpellContainerID', container.name)
         spell_containerized.remove_spelldata('RootSpellID')
         if self.is_container():
             spell_containerized.remove_spelldata('ContainerSpells')
-            spell_containerized.replace_spelldata('SpellFlags', r';IsLinkedSpellContainer', r'')
+            spell_containerized.remove_spellflag('IsLinkedSpellContainer')
         return spell_containerized
     
     def add_spelldata(self, key, value):
-        self._data[key] = value
+        self.data[key] = value
 
     def find_spelldata(self, key, find_re):
-        if self._data.get(key, None) and re.search(find_re, self._data[key]):
+        """ find_re may be a pattern string or a compiled re.Pattern """
+        value = self.data.get(key)
+        pattern = find_re if isinstance(find_re, re.Pattern) else re.compile(find_re)
+        if value and pattern.search(value):
             return True
         return False
     
+    def _contains(self, key, needle):
+        """ Plain substring test for spell data, cheaper than find_spelldata """
+        value = self.data.get(key)
+        return value is not None and needle in value
+
     def get_spelldata(self, key):
-        return self._data.get(key, None)
+        return self.data.get(key, None)
 
     def remove_spelldata(self, key):
-        if self.get_spelldata(key):
-            del self._data[key]
+        if self.data.get(key):
+            del self.data[key]
+
+    def remove_spellflag(self, flag):
+        """ Removes a flag from the semicolon separated SpellFlags as a whole token """
+        flags = self.data.get('SpellFlags')
+        if flags:
+            self.data['SpellFlags'] = ';'.join([f for f in flags.split(';') if f != flag])
 
     def replace_spelldata(self, key, find_re, replace_re):
-        if self.find_spelldata(key, find_re):
-            self._data[key] = re.sub(find_re, replace_re, self._data[key])
+        """ Substituting without a match leaves the value unchanged, so no separate search is needed """
+        value = self.data.get(key)
+        if value:
+            pattern = find_re if isinstance(find_re, re.Pattern) else re.compile(find_re)
+            self.data[key] = pattern.sub(replace_re, value)
 
     def get_rootspellname(self):
         if self.has_powerlevel:
             return self.get_spelldata('RootSpellID')
 
     def get_spellgroup(self):
-        if self.has_using():
-            return self._using
-        return self._name
+        """ Spells are grouped by the spell they are using, or by their own name otherwise """
+        return self.using or self.name
 
     def is_container(self):
-        return self.find_spelldata('ContainerSpells', '.+')
+        return self.find_spelldata('ContainerSpells', _RE_ANY)
 
     def has_powerlevel(self):
-        return self.find_spelldata('PowerLevel', '[0-9]+')
+        return self.find_spelldata('PowerLevel', _RE_NUMBER)
 
     def has_spellcontainer(self):
         return self.get_spelldata('SpellContainerID')
@@ -267,127 +281,144 @@ class Spell(object):
         return self.has_spellcontainer() and self.has_rootspell()
 
     def has_using(self):
-        return self._using
+        return self.using
 
     def has_rootspell(self):
         return self.get_spelldata('RootSpellID')
 
     def has_verbalcomponent(self):
-        return self.find_spelldata('SpellFlags', 'HasVerbalComponent')
+        return self._contains('SpellFlags', 'HasVerbalComponent')
 
     def uses_bonusaction(self):
-        return self.find_spelldata('UseCosts', 'BonusAction')
+        return self._contains('UseCosts', 'BonusAction')
         
     def uses_spellslot(self):
-        return self.find_spelldata('UseCosts', 'SpellSlot')
+        return self._contains('UseCosts', 'SpellSlot')
+
+    def _parse_quoted(self, line, prefix):
+        """ Returns the value up to the last quote of a header line starting with prefix, text after it is ignored """
+        end = line.rfind('"')
+        if end > len(prefix) and line.startswith(prefix):
+            return line[len(prefix):end]
+        return ""
 
     def parse_spellname(self, line):
-        re_name = r'(?P<headertype>new entry) "(?P<value>.+)"'
-        m = re.match(re_name, line)
-        if not m:
-            return ""
-        return m.group('value')
+        return self._parse_quoted(line, 'new entry "')
 
     def parse_entrytype(self, line):
-        re_type = r'(?P<headertype>type) "(?P<value>.+)"'
-        m = re.match(re_type, line)
-        if not m:
-            return ""
-        return m.group('value')
+        return self._parse_quoted(line, 'type "')
 
     def parse_spellusing(self, line):
-        re_using = r'(?P<headertype>using) "(?P<value>.+)"'
-        m = re.match(re_using, line)
-        if not m:
-            return ""
-        return m.group('value')
+        return self._parse_quoted(line, 'using "')
 
     def parse_spelldata(self, line):
-        re_data = r'(?P<datatype>data) "(?P<key>.+)" "(?P<value>.*)"'
-        m = re.match(re_data, line)
-        if not m:
+        """ Data lines have the form: data "key" "value", text after the last quote is ignored """
+        if not line.startswith('data "'):
+            return {}
+        k, sep, v = line[6:line.rfind('"')].rpartition('" "')
+        if not k or not sep:
             return {}
-        k = m.group('key')
-        v = m.group('value')
         return {k:v}
 
     def load(self, lines):
         """ Processes a block of lines into a Spell """
 
+        """ Walk the lines with an iterator rather than pop() from the front of the list """
+        lines = iter(lines)
+
         """ Spell name is stored in 'new entry' """
-        self._name = self.parse_spellname(lines.pop(0))
+        self.name = self.parse_spellname(next(lines))
         
         """ The entry type for spells is stored via 'type' and is always be set to 'SpellData' """
-        self._entrytype = self.parse_entrytype(lines.pop(0))
+        self._entrytype = self.parse_entrytype(next(lines))
         
         """ The actual spell type (e.g. 'Projectile') is stored simply as 'data' """
-        self._type = self.parse_spelldata(lines.pop(0))
+        self._type = self.parse_spelldata(next(lines))
         
         """ 
             Settings might be inherited from another spell pointed to via the 'using' key
-            This is an optional setting though so we only pop() this line if exists.
+            This is an optional setting though so the line is parsed as 'data' if it does not exist.
         """
-        peekline = lines[0]
-        self._using = self.parse_spellusing(peekline)
-        if self._using:
-            lines.pop(0)
+        peekline = next(lines, "")
+        self.using = self.parse_spellusing(peekline)
+        if not self.using:
+            d = self.parse_spelldata(peekline)
+            if d:
+                self.data.update(d)
 
         """ The rest of the lines should all be in 'data' """
         for line in lines:
             d = self.parse_spelldata(line)
             if d:
-                self._data.update(d)
+                self.data.update(d)
 
         """ We need to put back the spell type from the header into 'data' """
-        self._data.update(self._type)
+        self.data.update(self._type)
 
     def to_entry(self):
         """ Implements storage format used in files """
+        lines = []
+        self.add_entry_lines(lines)
+        return '\n'.join(lines)
+
+    def add_entry_lines(self, lines):
+        """ Appends the lines of the storage format to lines """
 
         """ Header first """
-        lines = [
-            f'''new entry "{self._name}"''',
-            f'''type "{self._entrytype}"''',
-            f'''data "SpellType" "{self._data['SpellType']}"''',
-            f'''using "{self._using}"'''
-        ]
+        lines.append(f'''new entry "{self.name}"''')
+        lines.append(f'''type "{self._entrytype}"''')
+        lines.append(f'''data "SpellType" "{self.data['SpellType']}"''')
     
-        """ Remove using line if not applicable """
-        if not self._using:
-            lines.pop()
-
-        """ Already specified in above header """
-        del self._data['SpellType']
+        """ Add using line only if applicable """
+        if self.using:
+            lines.append(f'''using "{self.using}"''')
 
-        """ Write remaining data entries """
-        for k, v in self._data.items():
+        """ Write remaining data entries, SpellType is already specified in above header """
+        for k, v in self.data.items():
+            if k == 'SpellType':
+                continue
             lines.append(f'data "{k}" "{v}"')
 
-        return '\n'.join(lines) 
-
 
 class Container(Spell):
     """ Containers are special spells that contain other spells through "ContainerSpells" """    
+    __slots__ = ('_children', '_spellgroup')
+
+    _children: list[Spell]
+    _spellgroup: str
+
     def __init__(self, spellgroup, spell):
         super().__init__()
-        self._name = copy.deepcopy(spell._name)
-        self._entrytype = copy.deepcopy(spell._entrytype)
-        self._type = copy.deepcopy(spell._type)
+        self.name = spell.name
+        self._entrytype = spell._entrytype
+        self._type = spell._type
         self._children = []
         self._spellgroup = spellgroup
-        self._data = copy.deepcopy(spell._data)
+        self.data = spell.data.copy()
         
         self.add_spelldata('ContainerSpells', '')
-        if not self.is_container():
-            self.replace_spelldata('SpellFlags', r'^(.*)$', r'\1;IsLinkedSpellContainer')
+        """ Spells without their own SpellFlags inherit them through using, so leave those untouched """
+        flags = self.data.get('SpellFlags')
+        if flags and 'IsLinkedSpellContainer' not in flags:
+            self.add_spelldata('SpellFlags', f'{flags};IsLinkedSpellContainer')
     
     def __repr__(self):
-        return f'Container({self._name})'
+        return f'Container({self.name})'
     
     def add(self, spell):
         self._children.append(spell)
-        children = ";".join([s.name for s in self._children])
-        self.add_spelldata('ContainerSpells', children)
+        """ Extend the running ContainerSpells string instead of rejoining all children """
+        children = self.data['ContainerSpells']
+        self.add_spelldata('ContainerSpells', f'{children};{spell.name}' if children else spell.name)
+
+    def add_all(self, spells):
+        """ Adds several spells at once, joining their names into ContainerSpells only once """
+        if not spells:
+            return
+        self._children.extend(spells)
+        children = self.data['ContainerSpells']
+        names = ';'.join(s.name for s in spells)
+        self.add_spelldata('ContainerSpells', f'{children};{names}' if children else names)
 
     @property
     def children(self):
@@ -395,14 +426,16 @@ class Container(Spell):
 
     @children.setter
     def children(self, value):
+        """ Replacing the children also replaces ContainerSpells, so the running string stays in step """
         self._children = value
+        self.add_spelldata('ContainerSpells', ';'.join(s.name for s in value))
 
     @children.deleter
     def children(self):
         del self._children
 
     def add_child(self, spell):
-        self._children.append(spell)
+        self.add(spell)
 
     @property
     def spellgroup(self):
@@ -417,11 +450,46 @@ class Container(Spell):
         del self._spellgroup
     
 
+def _build_group(spellgroup, spells, root_spells):
+    """ Creates the Container and meta spells for a single spell group """
+    logging.debug("Creating meta spells for %s with spells %s", spellgroup, spells)
+    container = Container(spellgroup, spells[0])
+    container.name = f'{spellgroup}_Metamagic'
+    meta_spells = []
+    for spell in spells:
+        spell_containerized = spell.containerized(container)
+
+        """ Add containerized spell to meta spells """
+        meta_spells.append(spell_containerized)
+
+        """ Spells with PowerLevel have their data in their using """
+        if spell.has_powerlevel():
+            test_spell = root_spells[spell.get_rootspellname()]
+        else:
+            test_spell = spell
+
+        """ Metamagic only applies to Spells that consume SpellSlots; evaluate this once per spell """
+        uses_spellslot = not test_spell.is_container() and test_spell.uses_spellslot()
+
+        """ Only add quickened variant for Spells that consume SpellSlots and don't already use BonusAction """
+        if uses_spellslot and not test_spell.uses_bonusaction():
+            meta_spells.append(spell.quickened(spell_containerized))
+
+        """ Only add subtle variant for Spells that consume SpellSlots and require verbal component """
+        if uses_spellslot and test_spell.has_verbalcomponent():
+            meta_spells.append(spell.subtle(spell_containerized))
+
+    container.add_all(meta_spells)
+    return container, meta_spells
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('source', help='source spell definitions file')
     parser.add_argument('--verbose', '-v', action='count', default=0, 
                         help='increase verbosity')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='number of processes used to create metamagic spells')
     args = vars(parser.parse_args())
 
     """ File settings """
@@ -437,7 +505,7 @@ if __name__ == "__main__":
                             encoding='utf-8', level=logging.WARN)
 
     """ Debug """
-    logging.debug(f"Source: {source}, Destination: {destination}")
+    logging.debug("Source: %s, Destination: %s", source, destination)
 
     """ Create and load Spell Library """
     library = Library()
@@ -448,7 +516,7 @@ if __name__ == "__main__":
         library.print()
 
     """ Extend Library with metamagic version of Spells """
-    metamagic_library = library.create_metamagic()
+    metamagic_library = library.create_metamagic(jobs=args['jobs'])
 
     """ Debug """
     if args['verbose'] > 0: